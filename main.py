@@ -0,0 +1,501 @@
+import os
+import base64
+import csv
+import io
+import itertools
+import json
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import google.auth
+from google.api_core.retry import Retry
+from google.cloud import videointelligence as vi
+from typing import Sequence
+from google.cloud import bigquery
+from google.cloud import storage
+from google.cloud import pubsub_v1
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import exceptions as bqs_exceptions
+from google.cloud.bigquery_storage_v1 import types as bqs_types
+from google.cloud.bigquery_storage_v1 import writer as bqs_writer
+from google.cloud.bigquery_storage_v1.services.big_query_write.transports import BigQueryWriteGrpcTransport
+from google.cloud.videointelligence_v1.services.video_intelligence_service.transports import VideoIntelligenceServiceGrpcTransport
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+import ijson
+from google.cloud.exceptions import NotFound
+from google.cloud.exceptions import GoogleCloudError
+
+OUTPUT_BUCKET = "gs://outputbucket-cloud9"
+OUTPUT_BUCKET_NAME = OUTPUT_BUCKET[len("gs://"):]
+PROJECT_ID = "video-analyzer-407616"
+DATASET_ID = "video_analytics"
+TABLE_ID_LABELS = "annotation_labels"
+TABLE_ID_TRANSCRIPT = "annotation_transcripts"
+# Smaller batches are appended through the Storage Write API, larger ones go through a load job
+BQ_LOAD_JOB_MIN_ROWS = int(os.getenv("BQ_LOAD_JOB_MIN_ROWS", "500"))
+VERBOSE = bool(os.getenv("VERBOSE"))
+# Transcriptions below this confidence are stored but not printed
+VERBOSE_MIN_CONFIDENCE = 0.8
+BACKFILL_TOPIC = os.getenv("BACKFILL_TOPIC", "video-backfill")
+# Used by backfill_bucket when an object has no video/* content type
+VIDEO_EXTENSIONS = {".3gp", ".avi", ".flv", ".m4v", ".mkv", ".mov", ".mp4", ".mpeg", ".mpg", ".webm", ".wmv"}
+
+# Only the label and speech results are stored, so only those are requested by default
+VI_FEATURES = os.getenv("VI_FEATURES", "LABEL_DETECTION,SPEECH_TRANSCRIPTION")
+
+# store_results_in_bigquery expects both label and speech results
+REQUIRED_FEATURES = [vi.Feature.LABEL_DETECTION, vi.Feature.SPEECH_TRANSCRIPTION]
+
+def _parse_features(names):
+    parsed = []
+    for name in names.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        # A typo would otherwise silently drop a feature that was meant to be requested
+        if name not in vi.Feature.__members__ or name == vi.Feature.FEATURE_UNSPECIFIED.name:
+            raise ValueError(f"Unknown feature {name!r} in VI_FEATURES.")
+        parsed.append(vi.Feature[name])
+    missing = [feature.name for feature in REQUIRED_FEATURES if feature not in parsed]
+    if missing:
+        raise ValueError("VI_FEATURES must include {}, whose results are stored in BigQuery.".format(", ".join(missing)))
+    return parsed
+
+features = _parse_features(VI_FEATURES)
+
+speech_config = vi.SpeechTranscriptionConfig(
+    language_code="en-US",
+    enable_automatic_punctuation=True,
+)
+
+person_config = vi.PersonDetectionConfig(
+    include_bounding_boxes=True,
+    include_attributes=False,
+    include_pose_landmarks=True,
+)
+
+face_config = vi.FaceDetectionConfig(
+    include_bounding_boxes=True,
+    include_attributes=True,
+)
+
+video_context = vi.VideoContext()
+if vi.Feature.SPEECH_TRANSCRIPTION in features:
+    video_context.speech_transcription_config = speech_config
+if vi.Feature.PERSON_DETECTION in features:
+    video_context.person_detection_config = person_config
+if vi.Feature.FACE_DETECTION in features:
+    video_context.face_detection_config = face_config
+
+# Only the input and output URIs change between videos
+annotate_request_template = vi.AnnotateVideoRequest(
+    features=features,
+    video_context=video_context,
+)
+
+dataset_ref = bigquery.DatasetReference(PROJECT_ID, DATASET_ID)
+table_ref_labels = bigquery.TableReference(dataset_ref, TABLE_ID_LABELS)
+table_ref_transcript = bigquery.TableReference(dataset_ref, TABLE_ID_TRANSCRIPT)
+
+# Define schema for the first table
+schema_labels = [
+    bigquery.SchemaField("file_name", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("label", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("confidence", "FLOAT", mode="NULLABLE"),
+    bigquery.SchemaField("start_time", "FLOAT", mode="NULLABLE"),
+    bigquery.SchemaField("end_time", "FLOAT", mode="NULLABLE"),
+    bigquery.SchemaField("file_uri", "STRING", mode="REQUIRED"),
+]
+# Define schema for the second table
+schema_transcript = [
+    bigquery.SchemaField("file_name", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("transcript", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("confidence", "FLOAT", mode="NULLABLE"),
+]
+
+# Rows are plain tuples in schema order
+LabelRow = namedtuple("LabelRow", [field.name for field in schema_labels])
+TranscriptRow = namedtuple("TranscriptRow", [field.name for field in schema_transcript])
+
+# Rows never hold None, so nothing is written as this; an empty string then loads as "" rather than NULL
+CSV_NULL_MARKER = "\\N"
+
+# Load jobs are used for bulk writes, the Storage Write API only for small result sets
+load_config_labels = bigquery.LoadJobConfig(
+    schema=schema_labels,
+    write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    source_format=bigquery.SourceFormat.CSV,
+    allow_quoted_newlines=True,
+    ignore_unknown_values=True,
+    null_marker=CSV_NULL_MARKER,
+)
+
+load_config_transcript = bigquery.LoadJobConfig(
+    schema=schema_transcript,
+    write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+    source_format=bigquery.SourceFormat.CSV,
+    allow_quoted_newlines=True,
+    ignore_unknown_values=True,
+    null_marker=CSV_NULL_MARKER,
+)
+
+# Keep BigQuery retries and waits well inside the function timeout
+bq_retry = Retry(initial=0.25, maximum=4.0, multiplier=2.0, deadline=30.0)
+BQ_WRITE_TIMEOUT = float(os.getenv("BQ_WRITE_TIMEOUT", "60"))
+
+# Small result sets are appended through the Storage Write API, which needs
+# a protobuf message type matching each table schema
+_PROTO_TYPES = {
+    "STRING": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+    "FLOAT": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+}
+
+def _row_descriptor(name, schema):
+    descriptor = descriptor_pb2.DescriptorProto(name=name)
+    for number, field in enumerate(schema, start=1):
+        descriptor.field.add(
+            name=field.name,
+            number=number,
+            type=_PROTO_TYPES[field.field_type],
+            label=(descriptor_pb2.FieldDescriptorProto.LABEL_REQUIRED if field.mode == "REQUIRED"
+                   else descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL),
+        )
+    return descriptor
+
+row_descriptor_labels = _row_descriptor("LabelRow", schema_labels)
+row_descriptor_transcript = _row_descriptor("TranscriptRow", schema_transcript)
+
+_row_file = descriptor_pb2.FileDescriptorProto(name="video_analytics_rows.proto", package=DATASET_ID, syntax="proto2")
+_row_file.message_type.extend([row_descriptor_labels, row_descriptor_transcript])
+_row_pool = descriptor_pool.DescriptorPool()
+_row_pool.Add(_row_file)
+LabelRowMessage = message_factory.GetMessageClass(_row_pool.FindMessageTypeByName(f"{DATASET_ID}.LabelRow"))
+TranscriptRowMessage = message_factory.GetMessageClass(_row_pool.FindMessageTypeByName(f"{DATASET_ID}.TranscriptRow"))
+
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    # Keep the connection alive so warm invocations skip the TLS/HTTP2 handshake
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+def _grpc_transport(transport_class):
+    return transport_class(channel=transport_class.create_channel(credentials=_creds(), options=GRPC_CHANNEL_OPTIONS))
+
+# Clients are created once per container and reused by warm invocations
+_CREDENTIALS = None
+_BQ_CLIENT = None
+_BQ_WRITE_CLIENT = None
+_VI_CLIENT = None
+_GCS_CLIENT = None
+_PUBSUB_CLIENT = None
+# Set once the result tables are known to exist in this container
+_TABLES_ENSURED = False
+
+def _creds():
+    # Discover the credentials once and share them, and their token refreshes, between all clients
+    global _CREDENTIALS
+    if _CREDENTIALS is None:
+        _CREDENTIALS, _ = google.auth.default()
+    return _CREDENTIALS
+
+def _bq():
+    global _BQ_CLIENT
+    _BQ_CLIENT = _BQ_CLIENT or bigquery.Client(project=PROJECT_ID, credentials=_creds())
+    return _BQ_CLIENT
+
+def _bq_write():
+    global _BQ_WRITE_CLIENT
+    _BQ_WRITE_CLIENT = _BQ_WRITE_CLIENT or bigquery_storage_v1.BigQueryWriteClient(transport=_grpc_transport(BigQueryWriteGrpcTransport))
+    return _BQ_WRITE_CLIENT
+
+def _vi():
+    global _VI_CLIENT
+    _VI_CLIENT = _VI_CLIENT or vi.VideoIntelligenceServiceClient(transport=_grpc_transport(VideoIntelligenceServiceGrpcTransport))
+    return _VI_CLIENT
+
+def _gcs():
+    global _GCS_CLIENT
+    _GCS_CLIENT = _GCS_CLIENT or storage.Client(project=PROJECT_ID, credentials=_creds())
+    return _GCS_CLIENT
+
+def _pubsub():
+    global _PUBSUB_CLIENT
+    _PUBSUB_CLIENT = _PUBSUB_CLIENT or pubsub_v1.PublisherClient(credentials=_creds())
+    return _PUBSUB_CLIENT
+
+def _output_name(object_name):
+    file_stem = object_name.split(".")[0]
+    return f"{file_stem}.json"
+
+def analyze_video(event, context):
+    print(event)
+    input_uri = "gs://" + event["bucket"] + "/" + event["name"]
+    output_uri = f"{OUTPUT_BUCKET}/{_output_name(event['name'])}"
+    request = vi.AnnotateVideoRequest()
+    vi.AnnotateVideoRequest.copy_from(request, annotate_request_template)
+    request.input_uri = input_uri
+    request.output_uri = output_uri
+    print(f'Processing video "{input_uri}"...')
+    video_client = _vi()
+    # The results are written to output_uri, which triggers store_video_results
+    operation = video_client.annotate_video(request=request)
+    return operation
+
+_RESULT_PREFIX = "annotation_results.item"
+# Only these parts of each result are built; everything else is skipped while parsing
+_RESULT_FIELDS = {
+    _RESULT_PREFIX + ".input_uri": "input_uri",
+    _RESULT_PREFIX + ".error": "error",
+}
+_RESULT_LIST_FIELDS = {
+    _RESULT_PREFIX + ".segment_label_annotations.item": "segment_label_annotations",
+    _RESULT_PREFIX + ".speech_transcriptions.item": "speech_transcriptions",
+}
+# The per-word timings make up most of a transcription but are not stored
+_SKIPPED_PREFIX = _RESULT_PREFIX + ".speech_transcriptions.item.alternatives.item.words"
+
+def load_annotation_results(bucket_name, blob_name):
+    # Yield the results one at a time while the JSON is read from the bucket
+    blob = _gcs().bucket(bucket_name).blob(blob_name)
+    with blob.open("rb") as f:
+        result, builder, field = None, None, None
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if builder is not None:
+                if prefix == _SKIPPED_PREFIX or prefix.startswith(_SKIPPED_PREFIX + "."):
+                    continue
+                builder.event(event, value)
+                if prefix == field and event in ("end_map", "end_array"):
+                    if field in _RESULT_LIST_FIELDS:
+                        result[_RESULT_LIST_FIELDS[field]].append(builder.value)
+                    else:
+                        result[_RESULT_FIELDS[field]] = builder.value
+                    builder, field = None, None
+            elif prefix == _RESULT_PREFIX and event == "start_map":
+                result = {"segment_label_annotations": [], "speech_transcriptions": []}
+            elif prefix == _RESULT_PREFIX and event == "end_map":
+                yield result
+            elif prefix in _RESULT_FIELDS or prefix in _RESULT_LIST_FIELDS:
+                if event in ("start_map", "start_array"):
+                    builder, field = ijson.ObjectBuilder(), prefix
+                    builder.event(event, value)
+                elif prefix in _RESULT_FIELDS:
+                    result[_RESULT_FIELDS[prefix]] = value
+
+def sorted_by_first_segment_confidence(labels: Sequence[dict],) -> Sequence[dict]:
+    return sorted(labels, key=lambda label: (label.get("segments") or [{}])[0].get("confidence", 0.0), reverse=True)
+
+def category_entities_to_str(category_entities: Sequence[dict]) -> str:
+    if not category_entities:
+        return ""
+    entities = ", ".join([e.get("description", "") for e in category_entities])
+    return f" ({entities})"
+
+def create_bigquery_tables():
+    global _TABLES_ENSURED
+    if _TABLES_ENSURED:
+        return
+    client = _bq()
+
+    # Create the labels table
+    try:
+        client.get_table(table_ref_labels, retry=bq_retry)
+        print("Table {} already exists. Skipping creation.".format(table_ref_labels.table_id))
+    except NotFound:
+        table_labels = bigquery.Table(table_ref_labels, schema=schema_labels)
+        table_labels = client.create_table(table_labels, retry=bq_retry)
+        print("Table {} created.".format(table_labels.table_id))
+
+    # Create the transcript table
+    try:
+        client.get_table(table_ref_transcript, retry=bq_retry)
+        print("Table {} already exists. Skipping creation.".format(table_ref_transcript.table_id))
+    except NotFound:
+        table_transcript = bigquery.Table(table_ref_transcript, schema=schema_transcript)
+        table_transcript = client.create_table(table_transcript, retry=bq_retry)
+        print("Table {} created.".format(table_transcript.table_id))
+
+    _TABLES_ENSURED = True
+
+def _row_message(row_type, row):
+    message = row_type()
+    for name, value in zip(row._fields, row):
+        setattr(message, name, value)
+    return message
+
+def _append_rows(write_client, table, rows, row_type, row_descriptor):
+    # Append the rows to the table's default stream in a single request
+    template = bqs_types.AppendRowsRequest(
+        write_stream=write_client.table_path(table.project, table.dataset_id, table.table_id) + "/streams/_default",
+        proto_rows=bqs_types.AppendRowsRequest.ProtoData(
+            writer_schema=bqs_types.ProtoSchema(proto_descriptor=row_descriptor),
+        ),
+    )
+    append_stream = bqs_writer.AppendRowsStream(write_client, template)
+    try:
+        proto_rows = bqs_types.ProtoRows(serialized_rows=[_row_message(row_type, row).SerializeToString() for row in rows])
+        request = bqs_types.AppendRowsRequest(proto_rows=bqs_types.AppendRowsRequest.ProtoData(rows=proto_rows))
+        try:
+            return list(append_stream.send(request).result(timeout=BQ_WRITE_TIMEOUT).row_errors)
+        except GoogleCloudError as e:
+            # Rejected rows fail the whole append, with the reasons on the response
+            row_errors = getattr(e.response, "row_errors", None)
+            if row_errors:
+                return list(row_errors)
+            raise
+    finally:
+        # A failed send already closes the stream, and closing it again would hide that error
+        try:
+            append_stream.close()
+        except bqs_exceptions.StreamClosedError:
+            pass
+
+def _write_rows(client, write_client, table, rows, job_config, row_type, row_descriptor):
+    # None tells the caller nothing was written, so it does not report new rows
+    if not rows:
+        return None
+    if len(rows) < BQ_LOAD_JOB_MIN_ROWS:
+        return _append_rows(write_client, table, rows, row_type, row_descriptor)
+    # The tuples are written straight to CSV, so no per-row dict or JSON encoding is needed
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+    job = client.load_table_from_file(io.BytesIO(buffer.getvalue().encode("utf-8")), table, job_config=job_config)
+    job.result(retry=bq_retry, timeout=BQ_WRITE_TIMEOUT)
+    return job.errors or []
+
+def _seconds(duration):
+    # The output file writes Durations as {"seconds": ..., "nanos": ...}, leaving out zero fields
+    return int(duration.get("seconds", 0)) + duration.get("nanos", 0) / 1e9
+
+def build_bigquery_rows(video_uri, results):
+    url_parts = video_uri.split('/')
+    file_name = url_parts[-1]
+
+    # Go through the results once, so they can be streamed in as they are parsed
+    label_annotations = []
+    transcriptions = []
+    for result in results:
+        label_annotations.extend(result.get("segment_label_annotations", []))
+        transcriptions.extend(t for t in result.get("speech_transcriptions", []) if t.get("alternatives"))
+
+    # Prepare data into the 'labels' table
+    rows_to_insert_labels = [
+        LabelRow(
+            file_name,
+            la["entity"]["description"],
+            s.get("confidence", 0.0),
+            _seconds(s["segment"].get("start_time_offset", {})),
+            _seconds(s["segment"].get("end_time_offset", {})),
+            video_uri,
+        )
+        for la in label_annotations
+        for s in la.get("segments", [])
+    ]
+
+    # Prepare data into the 'transcript' table
+    rows_to_insert_transcript = [
+        TranscriptRow(file_name, alt.get("transcript", ""), alt.get("confidence", 0.0))
+        for alt in (t["alternatives"][0] for t in transcriptions)
+    ]
+
+    if VERBOSE:
+        print(f" Video labels: {len(label_annotations)} ".center(80, "-"))
+        for la in sorted_by_first_segment_confidence(label_annotations):
+            categories = category_entities_to_str(la.get("category_entities"))
+            for s in la.get("segments", []):
+                t1 = _seconds(s["segment"].get("start_time_offset", {}))
+                t2 = _seconds(s["segment"].get("end_time_offset", {}))
+                print(f"{s.get('confidence', 0.0):4.0%} | {t1:7.3f} | {t2:7.3f} | {la['entity']['description']}{categories}")
+        transcripts_to_print = [row for row in rows_to_insert_transcript if row.confidence >= VERBOSE_MIN_CONFIDENCE]
+        print(f" Speech transcriptions: {len(transcripts_to_print)} ".center(80, "-"))
+        for row in transcripts_to_print:
+            print(f" {row.confidence:4.0%} | {row.transcript.strip()}")
+
+    return rows_to_insert_labels, rows_to_insert_transcript
+
+def store_results_in_bigquery(video_uri, results):
+    rows_to_insert_labels, rows_to_insert_transcript = build_bigquery_rows(video_uri, results)
+
+    if not rows_to_insert_labels and not rows_to_insert_transcript:
+        print("No rows to insert into BigQuery.")
+        return
+
+    create_bigquery_tables()
+    client = _bq()
+    # Create the write client here so the two workers below cannot each build one, and only if a table is appended to
+    appended = [rows for rows in (rows_to_insert_labels, rows_to_insert_transcript) if 0 < len(rows) < BQ_LOAD_JOB_MIN_ROWS]
+    write_client = _bq_write() if appended else None
+    try:
+        # Insert into the 'labels' and 'transcript' tables concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            future_labels = executor.submit(_write_rows, client, write_client, table_ref_labels, rows_to_insert_labels, load_config_labels, LabelRowMessage, row_descriptor_labels)
+            future_transcripts = executor.submit(_write_rows, client, write_client, table_ref_transcript, rows_to_insert_transcript, load_config_transcript, TranscriptRowMessage, row_descriptor_transcript)
+
+            annotation_labels = future_labels.result()
+            if annotation_labels == []:
+                print("New rows have been added to the 'labels' table.")
+            elif annotation_labels is not None:
+                print("Encountered errors while inserting rows into 'labels' table: {}".format(annotation_labels))
+
+            annotation_transcripts = future_transcripts.result()
+            if annotation_transcripts == []:
+                print("New rows have been added to the 'transcript' table.")
+            elif annotation_transcripts is not None:
+                print("Encountered errors while inserting rows into 'transcript' table: {}".format(annotation_transcripts))
+    except GoogleCloudError as e:
+        print("Error inserting rows into BigQuery: {}".format(e))
+    except FutureTimeoutError:
+        print("Timed out after {} s waiting for BigQuery to accept the rows.".format(BQ_WRITE_TIMEOUT))
+
+def process_video(event, context):
+    if "data" in event:
+        # Pub/Sub messages from backfill_bucket carry the storage event as JSON
+        event = json.loads(base64.b64decode(event["data"]))
+    operation = analyze_video(event, context)
+    print(f"Started annotation operation {operation.operation.name}")
+
+def _reported_errors(results, blob_name):
+    # Nothing waits on the annotation operation, so this is where its failures get reported
+    for result in results:
+        if "error" in result:
+            print("Annotation of {} failed: {}".format(result.get("input_uri", blob_name), result["error"]))
+        yield result
+
+def store_video_results(event, context):
+    print(event)
+    results = _reported_errors(load_annotation_results(event["bucket"], event["name"]), event["name"])
+    first = next(results, None)
+    if first is None:
+        print("No annotation results in {}.".format(event["name"]))
+        return
+    # The API reports the input as "/bucket/name"
+    input_uri = first["input_uri"]
+    if not input_uri.startswith("gs://"):
+        input_uri = "gs:/" + input_uri
+    store_results_in_bigquery(input_uri, itertools.chain([first], results))
+
+def _is_video(blob):
+    if blob.name.endswith("/"):
+        return False
+    content_type = blob.content_type or ""
+    return content_type.startswith("video/") or os.path.splitext(blob.name)[1].lower() in VIDEO_EXTENSIONS
+
+def backfill_bucket(bucket_name):
+    # Publish one message per video so each one is annotated by its own process_video invocation.
+    # Videos that already have an output file are skipped: annotating them again would rewrite
+    # the file and store_video_results would append the same rows a second time.
+    publisher = _pubsub()
+    topic_path = publisher.topic_path(PROJECT_ID, BACKFILL_TOPIC)
+    annotated = {blob.name for blob in _gcs().list_blobs(OUTPUT_BUCKET_NAME)}
+    futures = [
+        publisher.publish(topic_path, json.dumps({"bucket": bucket_name, "name": blob.name}).encode("utf-8"))
+        for blob in _gcs().list_blobs(bucket_name)
+        if _is_video(blob) and _output_name(blob.name) not in annotated
+    ]
+    for future in futures:
+        future.result()
+    print(f"Published {len(futures)} videos from {bucket_name} to {topic_path}")
@@ -0,0 +1,221 @@
+import csv
+import io
+import json
+import os
+from unittest import mock
+
+import pytest
+from google.api_core.exceptions import InvalidArgument
+from google.cloud.exceptions import NotFound
+
+import main
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "annotation_output.json")
+
+
+@pytest.fixture
+def output_blob(monkeypatch):
+    with open(FIXTURE, "rb") as f:
+        payload = f.read()
+    gcs = mock.MagicMock()
+    gcs.bucket.return_value.blob.return_value.open.side_effect = lambda mode: io.BytesIO(payload)
+    monkeypatch.setattr(main, "_GCS_CLIENT", gcs)
+    return gcs
+
+
+def test_load_annotation_results_parses_output_file(output_blob):
+    results = list(main.load_annotation_results("outputbucket-cloud9", "street.json"))
+
+    output_blob.bucket.assert_called_with("outputbucket-cloud9")
+    output_blob.bucket.return_value.blob.assert_called_with("street.json")
+    assert len(results) == 2
+    assert results[0]["input_uri"] == "/inputbucket-cloud9/street.mp4"
+    # Only the stored fields are built; the per-word timings are skipped
+    alternative = results[1]["speech_transcriptions"][0]["alternatives"][0]
+    assert alternative == {"transcript": "Look at the traffic today.", "confidence": 0.91}
+
+
+def test_build_bigquery_rows_from_output_file(output_blob):
+    results = main.load_annotation_results("outputbucket-cloud9", "street.json")
+
+    labels, transcripts = main.build_bigquery_rows("gs://inputbucket-cloud9/street.mp4", results)
+
+    assert labels == [
+        main.LabelRow("street.mp4", "car", 0.93, 0.0, pytest.approx(9.709), "gs://inputbucket-cloud9/street.mp4"),
+        main.LabelRow("street.mp4", "road", 0.71, 0.25, 12.5, "gs://inputbucket-cloud9/street.mp4"),
+    ]
+    assert transcripts == [
+        main.TranscriptRow("street.mp4", "Look at the traffic today.", 0.91),
+        main.TranscriptRow("street.mp4", "", 0.0),
+    ]
+
+
+def test_store_video_results_uses_gs_input_uri(output_blob, monkeypatch):
+    store = mock.MagicMock()
+    monkeypatch.setattr(main, "store_results_in_bigquery", store)
+
+    main.store_video_results({"bucket": "outputbucket-cloud9", "name": "street.json"}, None)
+
+    video_uri, results = store.call_args.args
+    assert video_uri == "gs://inputbucket-cloud9/street.mp4"
+    assert len(list(results)) == 2
+
+
+def test_row_message_copies_tuple_fields():
+    row = main.LabelRow("street.mp4", "car", 0.93, 0.0, 9.709, "gs://inputbucket-cloud9/street.mp4")
+
+    message = main._row_message(main.LabelRowMessage, row)
+
+    assert tuple(getattr(message, name) for name in row._fields) == row
+
+
+def test_backfill_bucket_publishes_only_new_videos(monkeypatch):
+    def blob(name, content_type=None):
+        b = mock.MagicMock(content_type=content_type)
+        b.name = name
+        return b
+
+    gcs = mock.MagicMock()
+    gcs.list_blobs.side_effect = lambda bucket_name: {
+        "outputbucket-cloud9": [blob("done.json")],
+        "inputbucket-cloud9": [
+            blob("done.mp4", "video/mp4"),
+            blob("new.mov"),
+            blob("clips/"),
+            blob("notes.txt", "text/plain"),
+            blob("raw", "video/webm"),
+        ],
+    }[bucket_name]
+    publisher = mock.MagicMock()
+    monkeypatch.setattr(main, "_GCS_CLIENT", gcs)
+    monkeypatch.setattr(main, "_PUBSUB_CLIENT", publisher)
+
+    main.backfill_bucket("inputbucket-cloud9")
+
+    published = [json.loads(call.args[1]) for call in publisher.publish.call_args_list]
+    assert published == [
+        {"bucket": "inputbucket-cloud9", "name": "new.mov"},
+        {"bucket": "inputbucket-cloud9", "name": "raw"},
+    ]
+
+
+def test_build_bigquery_rows_verbose_handles_label_without_segments(monkeypatch, capsys):
+    monkeypatch.setattr(main, "VERBOSE", True)
+    results = [{"segment_label_annotations": [
+        {"entity": {"description": "sky"}},
+        {"entity": {"description": "car"}, "segments": [{"segment": {}, "confidence": 0.5}]},
+    ]}]
+
+    labels, transcripts = main.build_bigquery_rows("gs://inputbucket-cloud9/street.mp4", results)
+
+    assert [row.label for row in labels] == ["car"]
+    assert "car" in capsys.readouterr().out
+
+
+def test_store_video_results_reports_errors_and_empty_files(monkeypatch, capsys):
+    store = mock.MagicMock()
+    monkeypatch.setattr(main, "store_results_in_bigquery", store)
+    monkeypatch.setattr(main, "load_annotation_results", lambda bucket_name, blob_name: [
+        {"input_uri": "/inputbucket-cloud9/street.mp4", "error": {"code": 3, "message": "Unsupported format"}},
+    ])
+
+    main.store_video_results({"bucket": "outputbucket-cloud9", "name": "street.json"}, None)
+
+    assert "Unsupported format" in capsys.readouterr().out
+
+    monkeypatch.setattr(main, "load_annotation_results", lambda bucket_name, blob_name: [])
+
+    main.store_video_results({"bucket": "outputbucket-cloud9", "name": "street.json"}, None)
+
+    assert "No annotation results" in capsys.readouterr().out
+    assert store.call_count == 1
+
+
+def test_store_results_in_bigquery_reports_only_written_tables(monkeypatch, capsys):
+    monkeypatch.setattr(main, "create_bigquery_tables", lambda: None)
+    monkeypatch.setattr(main, "_BQ_CLIENT", mock.MagicMock())
+    monkeypatch.setattr(main, "_BQ_WRITE_CLIENT", mock.MagicMock())
+    monkeypatch.setattr(main, "_append_rows", mock.MagicMock(return_value=[]))
+    results = [{"segment_label_annotations": [
+        {"entity": {"description": "car"}, "segments": [{"segment": {}, "confidence": 0.93}]},
+    ]}]
+
+    main.store_results_in_bigquery("gs://inputbucket-cloud9/street.mp4", results)
+
+    out = capsys.readouterr().out
+    assert "New rows have been added to the 'labels' table." in out
+    assert "'transcript'" not in out
+
+
+@pytest.mark.parametrize("names", ["LABEL_DETECTION,SPEECH_TRANSCRIPTON", "LABEL_DETECTION,SPEECH_TRANSCRIPTION,FEATURE_UNSPECIFIED"])
+def test_parse_features_rejects_unknown_names(names):
+    with pytest.raises(ValueError):
+        main._parse_features(names)
+
+
+def test_store_results_in_bigquery_reports_failed_append(monkeypatch, capsys):
+    monkeypatch.setattr(main, "create_bigquery_tables", lambda: None)
+    monkeypatch.setattr(main, "_BQ_CLIENT", mock.MagicMock())
+    write_client = mock.MagicMock()
+    write_client.table_path.return_value = "projects/video-analyzer-407616/datasets/video_analytics/tables/annotation_labels"
+    write_client.append_rows.side_effect = NotFound("Table annotation_labels was not found")
+    monkeypatch.setattr(main, "_BQ_WRITE_CLIENT", write_client)
+    results = [{"segment_label_annotations": [
+        {"entity": {"description": "car"}, "segments": [{"segment": {}, "confidence": 0.93}]},
+    ]}]
+
+    main.store_results_in_bigquery("gs://inputbucket-cloud9/street.mp4", results)
+
+    assert "Error inserting rows into BigQuery" in capsys.readouterr().out
+
+
+def test_append_rows_returns_row_errors(monkeypatch):
+    response = main.bqs_types.AppendRowsResponse(row_errors=[main.bqs_types.RowError(index=0, message="Invalid value")])
+    append_stream = mock.MagicMock()
+    append_stream.send.return_value.result.side_effect = InvalidArgument("Rows were rejected", response=response)
+    monkeypatch.setattr(main.bqs_writer, "AppendRowsStream", mock.MagicMock(return_value=append_stream))
+    write_client = mock.MagicMock()
+    write_client.table_path.return_value = "projects/video-analyzer-407616/datasets/video_analytics/tables/annotation_labels"
+    row = main.LabelRow("street.mp4", "car", 0.93, 0.0, 9.709, "gs://inputbucket-cloud9/street.mp4")
+
+    row_errors = main._append_rows(write_client, main.table_ref_labels, [row], main.LabelRowMessage, main.row_descriptor_labels)
+
+    assert [(e.index, e.message) for e in row_errors] == [(0, "Invalid value")]
+    append_stream.close.assert_called_once_with()
+
+
+def test_store_results_in_bigquery_skips_write_client_for_load_jobs(monkeypatch):
+    monkeypatch.setattr(main, "create_bigquery_tables", lambda: None)
+    client = mock.MagicMock()
+    client.load_table_from_file.return_value.errors = None
+    monkeypatch.setattr(main, "_BQ_CLIENT", client)
+    bq_write = mock.MagicMock()
+    monkeypatch.setattr(main, "_bq_write", bq_write)
+    monkeypatch.setattr(main, "BQ_LOAD_JOB_MIN_ROWS", 1)
+    results = [{"segment_label_annotations": [
+        {"entity": {"description": "car"}, "segments": [{"segment": {}, "confidence": 0.93}]},
+    ]}]
+
+    main.store_results_in_bigquery("gs://inputbucket-cloud9/street.mp4", results)
+
+    bq_write.assert_not_called()
+    client.load_table_from_file.assert_called_once()
+
+
+def test_write_rows_loads_transcripts_unchanged(monkeypatch):
+    client = mock.MagicMock()
+    client.load_table_from_file.return_value.errors = None
+    monkeypatch.setattr(main, "BQ_LOAD_JOB_MIN_ROWS", 1)
+    rows = [
+        main.TranscriptRow("street.mp4", "", 0.0),
+        main.TranscriptRow("street.mp4", 'Stop, "now"\nplease', 0.91),
+    ]
+
+    errors = main._write_rows(client, None, main.table_ref_transcript, rows, main.load_config_transcript, main.TranscriptRowMessage, main.row_descriptor_transcript)
+
+    assert errors == []
+    source, table = client.load_table_from_file.call_args.args
+    job_config = client.load_table_from_file.call_args.kwargs["job_config"]
+    assert job_config.null_marker == main.CSV_NULL_MARKER
+    loaded = list(csv.reader(io.StringIO(source.getvalue().decode("utf-8"), newline="")))
+    assert [main.TranscriptRow(name, transcript, float(confidence)) for name, transcript, confidence in loaded] == rows